@@ -1,8 +1,20 @@
+import os
+import re
+import json
+import queue
+import threading
+import time
+import sqlite3
 import streamlit as st
 import requests
+import numpy as np
 import pandas as pd
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 import gspread
 from openai import OpenAI
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.oauth2.service_account import Credentials
 from urllib.parse import urlparse
 
@@ -17,85 +29,344 @@ GCP_SERVICE_ACCOUNT = st.secrets["gcp_service_account"]
 # === 🤖 OpenAI Client ===
 client = OpenAI(api_key=OPENAI_API_KEY)
 
+# === 🌐 Shared HTTP Session ===
+# Cached across reruns so keep-alive connections to googleapis.com are reused.
+# Rate-limit and transient server errors are retried with a short backoff.
+HTTP_TIMEOUT = (3, 10)  # (connect, read) seconds
+
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    retries = Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries))
+    return session
+
+SESSION = get_http_session()
+
+# === 🧠 Semantic Cache ===
+# Past prompts are stored with their embeddings in sqlite; a lookup is a cosine
+# similarity scan over the unexpired vectors for the namespace and embedding
+# model. Entries expire after SEMANTIC_CACHE_TTL and only the newest
+# SEMANTIC_CACHE_MAX_ROWS are kept, which also bounds the cost of a lookup.
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "medassist")
+SEMANTIC_CACHE_DB = os.path.join(CACHE_DIR, "semantic_cache.sqlite3")
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_TTL = 24 * 3600  # seconds
+SEMANTIC_CACHE_MAX_ROWS = 1000
+
+def _connect_semantic_cache():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(SEMANTIC_CACHE_DB, timeout=10)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS semantic_cache "
+        "(namespace TEXT NOT NULL, text TEXT NOT NULL, embedding BLOB NOT NULL, value TEXT NOT NULL, "
+        "expires_at REAL NOT NULL)"
+    )
+    return conn
+
+def embed_text(text):
+    try:
+        response = client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return embedding / np.linalg.norm(embedding)
+    except Exception:
+        return None
+
+def _semantic_cache_key(namespace):
+    # Vectors from different embedding models are not comparable, so each model
+    # gets its own namespace.
+    return f"{EMBEDDING_MODEL}:{namespace}"
+
+def load_semantic_cache(namespace):
+    # Only reads sqlite, so it can run while the query is still being embedded.
+    try:
+        with closing(_connect_semantic_cache()) as conn:
+            return conn.execute(
+                "SELECT embedding, value FROM semantic_cache WHERE namespace = ? AND expires_at > ?",
+                (_semantic_cache_key(namespace), time.time())
+            ).fetchall()
+    except (OSError, sqlite3.Error):
+        return []
+
+def match_semantic_cache(rows, embedding):
+    if embedding is None:
+        return None
+    # Rows of the wrong size or with unreadable values are skipped, so a
+    # corrupt entry is a cache miss rather than an error.
+    rows = [row for row in rows if isinstance(row[0], bytes) and len(row[0]) == embedding.nbytes]
+    if not rows:
+        return None
+    try:
+        similarities = np.stack([np.frombuffer(row[0], dtype=np.float32) for row in rows]) @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        return json.loads(rows[best][1])
+    except (TypeError, ValueError):
+        return None
+
+def semantic_cache_lookup(namespace, embedding):
+    if embedding is None:
+        return None
+    return match_semantic_cache(load_semantic_cache(namespace), embedding)
+
+def semantic_cache_store(namespace, text, embedding, value):
+    if embedding is None:
+        return
+    now = time.time()
+    try:
+        with closing(_connect_semantic_cache()) as conn, conn:
+            conn.execute("DELETE FROM semantic_cache WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "INSERT INTO semantic_cache (namespace, text, embedding, value, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (_semantic_cache_key(namespace), text, embedding.tobytes(), json.dumps(value), now + SEMANTIC_CACHE_TTL)
+            )
+            conn.execute(
+                "DELETE FROM semantic_cache WHERE rowid NOT IN "
+                "(SELECT rowid FROM semantic_cache ORDER BY expires_at DESC LIMIT ?)",
+                (SEMANTIC_CACHE_MAX_ROWS,)
+            )
+    except (OSError, sqlite3.Error):
+        pass
+
 # === Trusted Medical Sources ===
-TRUSTED_SITES = [
+TRUSTED_SITES = (
     "site:nhs.uk", "site:nih.gov", "site:mayoclinic.org", "site:who.int",
     "site:cdc.gov", "site:clevelandclinic.org", "site:health.harvard.edu",
     "site:pubmed.ncbi.nlm.nih.gov", "site:webmd.com", "site:medlineplus.gov"
-]
+)
 
 # === Trust Score Function ===
+# Tiers are checked in order and the first tier with a substring of the domain
+# wins; TRUST_TIERS preserves the original if/elif chain.
+TRUST_TIERS = (
+    (("nhs.uk", "cdc.gov", "who.int", "mayoclinic.org", "clevelandclinic.org"), 5.0),
+    (("gov", "edu", "health.harvard.edu"), 4.5),
+    (("webmd.com", "medlineplus.gov"), 4.0),
+    (("pubmed",), 3.5),
+)
+DEFAULT_TRUST_SCORE = 3.0
+RECENT_YEAR_RE = re.compile(r"202[2-4]")
+
 def compute_trust_score(link, snippet):
     domain = urlparse(link).netloc.lower()
-
-    if any(site in domain for site in ["nhs.uk", "cdc.gov", "who.int", "mayoclinic.org", "clevelandclinic.org"]):
-        score = 5
-    elif any(site in domain for site in ["gov", "edu", "health.harvard.edu"]):
-        score = 4.5
-    elif "webmd.com" in domain or "medlineplus.gov" in domain:
-        score = 4
-    elif "pubmed" in domain:
-        score = 3.5
+    for sites, tier_score in TRUST_TIERS:
+        if any(site in domain for site in sites):
+            score = tier_score
+            break
     else:
-        score = 3
+        score = DEFAULT_TRUST_SCORE
 
-    if any(year in snippet for year in ["2024", "2023", "2022"]):
+    if RECENT_YEAR_RE.search(snippet):
         score += 0.5
 
     return min(score, 5.0)
 
 # === Google Search ===
-def get_medical_snippets(query, num_results=5):
-    domain_query = " OR ".join(TRUSTED_SITES)
-    full_query = f"{query} ({domain_query})"
-    params = {"key": GOOGLE_API_KEY, "cx": GOOGLE_CX, "q": full_query, "num": num_results}
+# Network-backed helpers are cached with st.cache_data and let errors propagate,
+# so a failed request is retried on the next rerun instead of being cached.
+GOOGLE_SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+MEDICAL_RESULTS_PER_SITE = 2
+# Only these item fields are used; asking for just them trims the response.
+GOOGLE_SEARCH_FIELDS = "items(title,link,snippet)"
+
+# Raw search responses are also kept on disk, so they survive restarts and are
+# shared by every process on the host, unlike the in-memory st.cache_data.
+SEARCH_CACHE_DB = os.path.join(CACHE_DIR, "search_cache.sqlite3")
+SEARCH_CACHE_TTL = 3600  # seconds
+
+def _connect_search_cache():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(SEARCH_CACHE_DB, timeout=10)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS search_cache "
+        "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+    )
+    return conn
+
+def search_cache_get(key):
     try:
-        response = requests.get("https://www.googleapis.com/customsearch/v1", params=params)
-        response.raise_for_status()
-        items = response.json().get("items", [])
-        items.sort(key=lambda x: 0 if "nhs.uk" in x.get("link", "") else 1)
-
-        results = []
-        for item in items:
-            title = item["title"]
-            link = item["link"]
-            snippet = item["snippet"]
-            score = compute_trust_score(link, snippet)
-            results.append((title, link, snippet, score))
-        return results
-    except Exception:
-        return []
+        with closing(_connect_search_cache()) as conn:
+            row = conn.execute(
+                "SELECT value FROM search_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+    except (OSError, sqlite3.Error):
+        return None
+    return json.loads(row[0]) if row else None
+
+def search_cache_set(key, value):
+    now = time.time()
+    try:
+        with closing(_connect_search_cache()) as conn, conn:
+            conn.execute("DELETE FROM search_cache WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "INSERT OR REPLACE INTO search_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now + SEARCH_CACHE_TTL)
+            )
+    except (OSError, sqlite3.Error):
+        pass
+
+def google_search(cx, query, num_results):
+    cache_key = json.dumps([cx, query, num_results, GOOGLE_SEARCH_FIELDS])
+    items = search_cache_get(cache_key)
+    if items is not None:
+        return items
+
+    params = {"key": GOOGLE_API_KEY, "cx": cx, "q": query, "num": num_results, "fields": GOOGLE_SEARCH_FIELDS}
+    response = SESSION.get(GOOGLE_SEARCH_URL, params=params, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    items = response.json().get("items", [])
+    search_cache_set(cache_key, items)
+    return items
+
+def search_sites(cx, query, site_filters, num_results_per_site):
+    # One request per site filter, run concurrently; items keep the filter order.
+    # Raises only when every site fails, so partial results are still returned.
+    items = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(site_filters)) as ex:
+        futures = [ex.submit(google_search, cx, f"{query} {site_filter}", num_results_per_site) for site_filter in site_filters]
+        for future in futures:
+            try:
+                items.extend(future.result())
+            except Exception as e:
+                errors.append(e)
+    if len(errors) == len(site_filters):
+        raise errors[0]
+    return items
+
+@st.cache_data(ttl=600, show_spinner=False)
+def get_medical_snippets(query, num_results=5):
+    # Searching each trusted site separately stops one authority crowding out
+    # the others. The merged results are deduplicated and scored once, sorted
+    # by trust score, and then ranked so every host's best result comes before
+    # any host's second, keeping score order within each rank.
+    scored = []
+    seen = set()
+    for item in search_sites(GOOGLE_CX, query, _KB["trusted_filters"], MEDICAL_RESULTS_PER_SITE):
+        # `fields` doesn't guarantee every key, so an item without a link is
+        # skipped on its own instead of failing the whole search.
+        link = item.get("link")
+        if not link or link in seen:
+            continue
+        seen.add(link)
+        snippet = item.get("snippet", "")
+        scored.append((item.get("title", link), link, snippet, compute_trust_score(link, snippet)))
+    scored.sort(key=lambda result: result[3], reverse=True)
+
+    ranked = []
+    host_counts = {}
+    for result in scored:
+        host = urlparse(result[1]).hostname
+        host_rank = host_counts.get(host, 0)
+        host_counts[host] = host_rank + 1
+        ranked.append((host_rank, result))
+    ranked.sort(key=lambda entry: entry[0])
+    return [result for _, result in ranked[:num_results]]
 
 # === ChatGPT Answering ===
-def answer_medical_question(question):
-    snippets = get_medical_snippets(question)
+ANSWER_DISCLAIMER = "\n\n**Disclaimer:** Always consult your healthcare provider."
+
+# Static instructions go in the system message and the per-request content
+# last, so every request shares an identical prefix. The rubrics are below
+# OpenAI's 1024-token prompt-caching minimum, so nothing is cached today; the
+# layout only keeps the instructions fixed and out of the per-request text.
+ANSWER_CLOSING = "Talk to a doctor to be sure."
+ANSWER_INSTRUCTIONS = f"""
+Answer clearly using the snippets provided by the user.
+Mention both common and serious conditions if symptoms provided.
+End with this sentence on its own line: "{ANSWER_CLOSING}"
+"""
+ANSWER_OPTIONS = {"max_tokens": 400, "temperature": 0.3}
+
+# Routine questions go to the faster mini model; urgent ones and long inputs
+# get the full model.
+FULL_MODEL = "gpt-4o"
+FAST_MODEL = "gpt-4o-mini"
+FAST_MODEL_MAX_CHARS = 400
+
+def pick_model(text, severity):
+    if severity.startswith(("🔴", "🟠")) or len(text) > FAST_MODEL_MAX_CHARS:
+        return FULL_MODEL
+    return FAST_MODEL
+
+def stream_chat(instructions, content, model, options, closing):
+    # The required closing line is used as a stop sequence so generation ends
+    # there. It only matches at the start of a line, so the same sentence quoted
+    # mid-answer does not cut the reply short. The API drops the stop text, so
+    # the closing is yielded back at the end unless the model already wrote it.
+    stream = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": content}
+        ],
+        stream=True,
+        stop=["\n" + closing],
+        **options
+    )
+    text = ""
+    for chunk in stream:
+        if chunk.choices:
+            token = chunk.choices[0].delta.content or ""
+            text += token
+            yield token
+    if text.rstrip().endswith(closing):
+        return
+    yield ("\n" if text.endswith("\n") else "\n\n" if text else "") + closing
+
+def _stream_answer(namespace, question, prompt, model, embedding, sources):
+    answer = ""
+    try:
+        for token in stream_chat(ANSWER_INSTRUCTIONS, prompt, model, ANSWER_OPTIONS, ANSWER_CLOSING):
+            answer += token
+            yield token
+    except Exception as e:
+        yield f"OpenAI API Error: {e}"
+        return
+    yield ANSWER_DISCLAIMER
+    semantic_cache_store(namespace, question, embedding, [answer.strip() + ANSWER_DISCLAIMER, sources])
+
+def answer_medical_question(question, severity, demographics=""):
+    # Returns (answer_stream, sources); the stream yields the answer text in
+    # chunks as the model generates it.
+    # The semantic cache matches on the bare question only; demographics are
+    # part of the namespace, so a cached answer is only reused for the same
+    # patient details.
+    namespace = f"answer:{demographics}"
+    full_query = demographics + question
+    # The cache is checked before searching, so a hit skips the per-site search
+    # fan-out and its Custom Search quota. The cached rows are read from sqlite
+    # in a worker while the question is embedded here.
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        rows = ex.submit(load_semantic_cache, namespace)
+        embedding = embed_text(question)
+        cached = match_semantic_cache(rows.result(), embedding)
+    if cached:
+        answer, sources = cached
+        return iter([answer]), [tuple(source) for source in sources]
+
+    try:
+        snippets = get_medical_snippets(full_query)
+    except Exception:
+        snippets = []
     if not snippets:
-        return "Sorry, no reliable sources available now.", []
+        return iter(["Sorry, no reliable sources available now."]), []
 
     context = "\n".join(f"- **{title}**: {snippet}" for title, link, snippet, score in snippets)
     sources = [(title, link, snippet, score) for title, link, snippet, score in snippets]
 
     prompt = f"""
-Answer clearly using snippets below.
-Mention both common and serious conditions if symptoms provided.
-End with: "Talk to a doctor to be sure."
-
 Snippets:
 {context}
 
-Question: {question}
+Question: {full_query}
 
 Answer:
 """
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        answer = response.choices[0].message.content.strip()
-        return answer + "\n\n**Disclaimer:** Always consult your healthcare provider.", sources
-    except Exception as e:
-        return f"OpenAI API Error: {e}", []
+    model = pick_model(full_query, severity)
+    return _stream_answer(namespace, question, prompt, model, embedding, sources), sources
 
 # === Proactive Advisories ===
 RISK_SNIPPETS = {
@@ -110,8 +381,13 @@ RISK_SNIPPETS = {
     "rash": "If rash is accompanied by fever or trouble breathing, see a doctor quickly."
 }
 
+@st.cache_data(ttl=3600, max_entries=1024, show_spinner=False)
 def get_risk_snippets(query):
-    return [snippet for keyword, snippet in RISK_SNIPPETS.items() if keyword in query.lower()]
+    # A plain substring scan measured faster than a compiled lookahead
+    # alternation, even with a few hundred keywords, and it reports every
+    # overlapping or prefix-sharing keyword.
+    q = query.lower()
+    return [snippet for keyword, snippet in _KB["risk"] if keyword in q]
 
 # === Severity Categorization ===
 SEVERITY_KEYWORDS = {
@@ -120,80 +396,250 @@ SEVERITY_KEYWORDS = {
     "🟢 Routine": []
 }
 
+@st.cache_data(ttl=3600, max_entries=1024, show_spinner=False)
 def classify_severity(query):
     q = query.lower()
-    for level, words in SEVERITY_KEYWORDS.items():
-        if any(w in q for w in words):
+    for level, pattern in _KB["severity_patterns"]:
+        if pattern.search(q):
             return level
     return "🟢 Routine"
 
 # === Social Media Search ===
-SOCIAL_MEDIA_SITES = ["site:reddit.com", "site:healthunlocked.com"]
+SOCIAL_MEDIA_SITES = ("site:reddit.com", "site:healthunlocked.com")
 
+@st.cache_data(ttl=600, show_spinner=False)
 def get_social_snippets(query, num_results_per_site=5):
     snippets = []
-    for site in SOCIAL_MEDIA_SITES:
-        full_query = f"{query} ({site})"
-        params = {"key": GOOGLE_API_KEY, "cx": SOCIAL_GOOGLE_CX, "q": full_query, "num": num_results_per_site}
-        try:
-            response = requests.get("https://www.googleapis.com/customsearch/v1", params=params)
-            response.raise_for_status()
-            for item in response.json().get("items", []):
-                title = item["title"]
-                link = item["link"]
-                snippet = item["snippet"]
-                score = compute_trust_score(link, snippet) - 1
-                snippets.append((title, link, snippet, max(score, 1.0)))
-        except Exception:
+    for item in search_sites(SOCIAL_GOOGLE_CX, query, _KB["social_filters"], num_results_per_site):
+        link = item.get("link")
+        if not link:
             continue
+        title = item.get("title", link)
+        snippet = item.get("snippet", "")
+        score = compute_trust_score(link, snippet) - 1
+        snippets.append((title, link, snippet, max(score, 1.0)))
     return snippets
 
+# === 📦 Knowledge Base ===
+# Frozen catalogs and matchers derived from the literals above. Built once per
+# process with st.cache_resource instead of on every rerun; passing the
+# literals in means editing them still invalidates the cache.
+@st.cache_resource(show_spinner=False)
+def _load_kb(risk_snippets, severity_keywords, trusted_sites, social_sites):
+    return {
+        "risk": tuple(risk_snippets.items()),
+        "severity_patterns": tuple(
+            (level, re.compile("|".join(re.escape(w) for w in words)))
+            for level, words in severity_keywords.items() if words
+        ),
+        "trusted_filters": tuple(f"({site})" for site in trusted_sites),
+        "social_filters": tuple(f"({site})" for site in social_sites),
+    }
+
+_KB = _load_kb(RISK_SNIPPETS, SEVERITY_KEYWORDS, TRUSTED_SITES, SOCIAL_MEDIA_SITES)
+
+# === Social Media Fact-Checking ===
+FACT_CHECK_WORKERS = 8
+
+FACT_CHECK_CLOSING = "Social media content may not be fully reliable. Consult a healthcare provider."
+FACT_CHECK_INSTRUCTIONS = f"""
+The user will send a social media post snippet from a health-related discussion. Verify the medical information presented in it.
+Use trusted guidelines (e.g., NHS, WHO, CDC) and specify what is correct or incorrect.
+
+Respond clearly with bullet points:
+- ✅ Valid claims
+- ❌ Misinformation
+- 🟢 Any advice or warning
+
+Always end with this on its own line: "{FACT_CHECK_CLOSING}"
+"""
+FACT_CHECK_OPTIONS = {"max_tokens": 250, "temperature": 0.2, "top_p": 0.9}
+
+def build_fact_check_prompt(snippet):
+    return f'Post:\n"{snippet}"'
+
+def stream_fact_check(snippet, severity):
+    embedding = embed_text(snippet)
+    cached = semantic_cache_lookup("fact_check", embedding)
+    if cached:
+        yield cached
+        return
+
+    prompt = build_fact_check_prompt(snippet)
+    model = pick_model(snippet, severity)
+    fact_check = ""
+    for token in stream_chat(FACT_CHECK_INSTRUCTIONS, prompt, model, FACT_CHECK_OPTIONS, FACT_CHECK_CLOSING):
+        fact_check += token
+        yield token
+    semantic_cache_store("fact_check", snippet, embedding, fact_check.strip())
+
+def stream_fact_checks(snippets, severity):
+    # Streams every fact-check concurrently and yields (index, text so far,
+    # finished) whenever any of them receives a token, so the caller can update
+    # the UI from the script thread. `finished` is True only on a post's last
+    # update when its fact-check succeeded; a failed one ends with the error
+    # appended and `finished` False.
+    updates = queue.Queue()
+
+    def run(i, snippet):
+        try:
+            for token in stream_fact_check(snippet, severity):
+                updates.put((i, token, None))
+            updates.put((i, "", "done"))
+        except Exception as e:
+            updates.put((i, f"\n\nError verifying this post: {e}", "failed"))
+
+    texts = [""] * len(snippets)
+    ex = ThreadPoolExecutor(max_workers=FACT_CHECK_WORKERS)
+    try:
+        for i, snippet in enumerate(snippets):
+            ex.submit(run, i, snippet)
+        pending = len(snippets)
+        while pending:
+            i, token, status = updates.get()
+            if status:
+                pending -= 1
+            texts[i] += token
+            yield i, texts[i], status == "done"
+    finally:
+        # If the script is interrupted mid-stream, don't block on the remaining
+        # streams: queued fact-checks are dropped and running ones finish in
+        # the background.
+        ex.shutdown(wait=False, cancel_futures=True)
+
+# === 📝 Feedback Sheet ===
+# Feedback rows are queued and appended by a background thread in batches of at
+# most FEEDBACK_BATCH_SIZE rows, flushed after FEEDBACK_FLUSH_INTERVAL seconds of
+# quiet, so submitting the form never waits on the Sheets API. A failed batch is
+# retried with exponential backoff up to FEEDBACK_MAX_BACKOFF; meanwhile at most
+# FEEDBACK_MAX_PENDING rows wait in the queue, and the oldest are dropped first.
+FEEDBACK_BATCH_SIZE = 20
+FEEDBACK_FLUSH_INTERVAL = 2  # seconds
+FEEDBACK_MAX_BACKOFF = 300  # seconds
+FEEDBACK_MAX_PENDING = 500
+
+def open_feedback_sheet():
+    creds = Credentials.from_service_account_info(GCP_SERVICE_ACCOUNT, scopes=[
+        "https://spreadsheets.google.com/feeds",
+        "https://www.googleapis.com/auth/drive"
+    ])
+    return gspread.authorize(creds).open(GOOGLE_SHEET_NAME).sheet1
+
+def _write_feedback(feedback_queue):
+    sheet = None
+    batch = []
+    backoff = FEEDBACK_FLUSH_INTERVAL
+    while True:
+        if len(batch) < FEEDBACK_BATCH_SIZE:
+            try:
+                batch.append(feedback_queue.get(timeout=FEEDBACK_FLUSH_INTERVAL if batch else None))
+                continue
+            except queue.Empty:
+                pass
+        try:
+            if sheet is None:
+                sheet = open_feedback_sheet()
+            # RAW so free-text comments starting with "=" are never evaluated as formulas.
+            sheet.append_rows(batch, value_input_option="RAW")
+            batch = []
+            backoff = FEEDBACK_FLUSH_INTERVAL
+        except Exception:
+            # Keep the batch and reconnect after backing off.
+            sheet = None
+            time.sleep(backoff)
+            backoff = min(backoff * 2, FEEDBACK_MAX_BACKOFF)
+
+@st.cache_resource
+def get_feedback_queue():
+    feedback_queue = queue.Queue(maxsize=FEEDBACK_MAX_PENDING)
+    threading.Thread(target=_write_feedback, args=(feedback_queue,), daemon=True).start()
+    return feedback_queue
+
+def submit_feedback(row):
+    feedback_queue = get_feedback_queue()
+    while True:
+        try:
+            feedback_queue.put_nowait(row)
+            return
+        except queue.Full:
+            try:
+                feedback_queue.get_nowait()
+            except queue.Empty:
+                pass
+
 # === Streamlit UI ===
 st.set_page_config(page_title="AI Medical Assistant", page_icon="🩺", layout="centered")
 st.title("🩺 AI-Powered Medical Assistant")
 
+MAX_HISTORY = 50
+
 if "history" not in st.session_state:
     st.session_state.history = []
 if "last_question" not in st.session_state:
     st.session_state.last_question = ""
+if "last_sm_key" not in st.session_state:
+    st.session_state.last_sm_key = None
+    st.session_state.last_sm_result = None
+    st.session_state.last_sm_fact_checks = None
 
 user_age = st.sidebar.text_input("Your Age (optional)")
 user_gender = st.sidebar.selectbox("Your Gender (optional)", ["Prefer not to say", "Male", "Female", "Other"])
 
 tab1, tab2, tab3 = st.tabs(["🧠 Ask Question", "📜 History", "🌐 Social Media Check"])
 
-with tab1:
+def render_answer(entry):
+    st.markdown(f"### 🚨 Severity Level: {entry['Severity']}")
+    st.markdown("### ✅ Answer")
+    st.write(entry["Answer"])
+
+    if entry["Advisories"]:
+        st.markdown("### ⚠️ Proactive Health Advisory")
+        for adv in entry["Advisories"]:
+            st.warning(adv)
+
+    if entry["Sources"]:
+        st.markdown("### 📚 Sources with Trust Scores")
+        for title, link, snippet, score in entry["Sources"]:
+            stars = "⭐" * int(score)
+            st.markdown(f"- [{title}]({link}) ({stars})\n\n> {snippet}")
+
+# Tab 1 runs as a fragment so interacting with the question box reruns only
+# this tab; the whole app is rerun once a new answer is ready so History and
+# Social Media Check pick it up.
+@st.fragment
+def ask_fragment(user_age, user_gender):
     question = st.text_input("Enter your medical question:")
     if st.button("Get Answer") and question:
         st.session_state.last_question = question
         demographics = f"For a {user_age}-year-old {user_gender.lower()}, " if user_age or user_gender != "Prefer not to say" else ""
-        full_query = demographics + question
         with st.spinner("Generating response..."):
-            answer, sources = answer_medical_question(full_query)
-            risk_advisories = get_risk_snippets(question)
             severity = classify_severity(question)
+            answer_stream, sources = answer_medical_question(question, severity, demographics)
+            risk_advisories = get_risk_snippets(question)
 
         st.markdown(f"### 🚨 Severity Level: {severity}")
         st.markdown("### ✅ Answer")
-        st.write(answer)
+        answer = st.write_stream(answer_stream)
 
-        if risk_advisories:
-            st.markdown("### ⚠️ Proactive Health Advisory")
-            for adv in risk_advisories:
-                st.warning(adv)
-
-        if sources:
-            st.markdown("### 📚 Sources with Trust Scores")
-            for title, link, snippet, score in sources:
-                stars = "⭐" * int(score)
-                st.markdown(f"- [{title}]({link}) ({stars})\n\n> {snippet}")
-
-        st.session_state.history.append({
+        entry = {
             "Question": question,
             "Answer": answer,
             "Sources": sources,
-            "Severity": severity
-        })
+            "Severity": severity,
+            "Advisories": risk_advisories
+        }
+        # Re-asking the same question replaces its entry; only the most recent
+        # MAX_HISTORY entries are kept.
+        history = st.session_state.history
+        if history and history[-1]["Question"] == question:
+            history = history[:-1]
+        st.session_state.history = (history + [entry])[-MAX_HISTORY:]
+        st.rerun()
+    elif st.session_state.history:
+        render_answer(st.session_state.history[-1])
+
+with tab1:
+    ask_fragment(user_age, user_gender)
 
 with tab2:
     st.markdown("### 📜 Your Session History")
@@ -201,19 +647,27 @@ with tab2:
         st.info("No questions asked yet.")
     else:
         for i, entry in enumerate(reversed(st.session_state.history), 1):
-            st.markdown(f"**Q{i}: {entry['Question']}** ({entry['Severity']})")
-            st.write(entry['Answer'])
-            st.markdown("---")
+            with st.expander(f"Q{i}: {entry['Question']} ({entry['Severity']})", expanded=i == 1):
+                st.write(entry['Answer'])
 
 with tab3:
     st.markdown("### 🌐 Social Media Medical Fact-Checking")
     sm_query = st.session_state.last_question
 
     if sm_query:
-        with st.spinner("Retrieving and analyzing posts..."):
-            sm_snippets = get_social_snippets(sm_query)
-            risk_advisories = get_risk_snippets(sm_query)
-            severity = classify_severity(sm_query)
+        # Search and fact-check only when the question changes; reruns from
+        # unrelated widgets reuse the stored results.
+        sm_key = (sm_query,)
+        if sm_key != st.session_state.last_sm_key:
+            with st.spinner("Retrieving and analyzing posts..."):
+                try:
+                    sm_snippets = get_social_snippets(sm_query)
+                except Exception:
+                    sm_snippets = []
+                st.session_state.last_sm_result = (sm_snippets, get_risk_snippets(sm_query), classify_severity(sm_query))
+                st.session_state.last_sm_fact_checks = None
+                st.session_state.last_sm_key = sm_key
+        sm_snippets, risk_advisories, severity = st.session_state.last_sm_result
 
         st.markdown(f"### 🚨 Severity Level: {severity}")
 
@@ -226,58 +680,47 @@ with tab3:
             st.warning("No relevant social media posts found.")
         else:
             st.markdown("### 🧾 Verified Posts from Social Media")
-            for i, (title, link, snippet, score) in enumerate(sm_snippets, 1):
+            # Finished fact-checks are stored one by one, so a rerun that
+            # interrupts streaming only restarts the posts still in progress.
+            if st.session_state.last_sm_fact_checks is None:
+                st.session_state.last_sm_fact_checks = [None] * len(sm_snippets)
+            fact_checks = st.session_state.last_sm_fact_checks
+
+            placeholders = []
+            for i, (title, link, snippet, score) in enumerate(sm_snippets):
                 stars = "⭐" * int(score)
-                st.markdown(f"**Post {i}:** [{title}]({link}) ({stars})")
+                st.markdown(f"**Post {i + 1}:** [{title}]({link}) ({stars})")
                 st.markdown(f"> {snippet}")
-
-                prompt = f"""
-Below is a social media post snippet from a health-related discussion. Verify the medical information presented in it.
-Use trusted guidelines (e.g., NHS, WHO, CDC) and specify what is correct or incorrect.
-
-Post:
-\"{snippet}\"
-
-Respond clearly with bullet points:
-- ✅ Valid claims
-- ❌ Misinformation
-- 🟢 Any advice or warning
-
-Always end with: "Social media content may not be fully reliable. Consult a healthcare provider."
-"""
-                try:
-                    response = client.chat.completions.create(
-                        model="gpt-4o",
-                        messages=[{"role": "user", "content": prompt}]
-                    )
-                    fact_check = response.choices[0].message.content.strip()
-                except Exception as e:
-                    fact_check = f"Error verifying this post: {e}"
-
                 st.markdown("**🔍 Fact-Check Result:**")
-                st.info(fact_check)
+                placeholder = st.empty()
+                placeholder.info(fact_checks[i] if fact_checks[i] is not None else "Verifying this post...")
+                placeholders.append(placeholder)
                 st.markdown("---")
+
+            todo = [i for i, fact_check in enumerate(fact_checks) if fact_check is None]
+            for j, fact_check, finished in stream_fact_checks([sm_snippets[i][2] for i in todo], severity):
+                placeholders[todo[j]].info(fact_check)
+                if finished:
+                    fact_checks[todo[j]] = fact_check
     else:
         st.info("Ask a question in Tab 1 to populate social media analysis.")
 
-# # === Feedback Form ===
-# st.markdown("---")
-# st.markdown("### 💬 Leave Feedback")
-
-# creds = Credentials.from_service_account_info(GCP_SERVICE_ACCOUNT, scopes=[
-#     "https://spreadsheets.google.com/feeds",
-#     "https://www.googleapis.com/auth/drive"
-# ])
-# gc = gspread.authorize(creds)
-# feedback_sheet = gc.open(GOOGLE_SHEET_NAME).sheet1
-
-# with st.form("feedback_form"):
-#     st.markdown("*(Optional)* Rate your experience and provide feedback.")
-#     rating = st.radio("How would you rate your experience?", ["⭐", "⭐⭐", "⭐⭐⭐", "⭐⭐⭐⭐", "⭐⭐⭐⭐⭐"], index=4, horizontal=True)
-#     comments = st.text_area("Your Feedback")
-#     if st.form_submit_button("Submit Feedback"):
-#         feedback_sheet.append_row([rating, comments])
-#         st.success("✅ Thank you for your feedback!")
+# === Feedback Form ===
+st.markdown("---")
+st.markdown("### 💬 Leave Feedback")
+
+# Runs as a fragment so rating or submitting feedback doesn't rerun the tabs.
+@st.fragment
+def feedback_fragment():
+    with st.form("feedback_form"):
+        st.markdown("*(Optional)* Rate your experience and provide feedback.")
+        rating = st.radio("How would you rate your experience?", ["⭐", "⭐⭐", "⭐⭐⭐", "⭐⭐⭐⭐", "⭐⭐⭐⭐⭐"], index=4, horizontal=True)
+        comments = st.text_area("Your Feedback")
+        if st.form_submit_button("Submit Feedback"):
+            submit_feedback([rating, comments])
+            st.success("✅ Thank you for your feedback!")
+
+feedback_fragment()
 
 # === Footer ===
 st.markdown("---")